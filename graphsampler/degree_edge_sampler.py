@@ -4,17 +4,15 @@
 import torch
 import os
 import dgl
-from .graph_sampler import GraphSampler
+from .graph_sampler import GraphSampler, weighted_choices
 import copy
-import random
-import numpy as np
 
 class DegreeEdgeSampler(GraphSampler):
     """
     Samples the nodes in the graph in a uniform way.
     """
 
-    def __init__(self, p = 0.5, method = 'score', graph_save_dir = None, directed = False):
+    def __init__(self, p = 0.5, method = 'score', graph_save_dir = None, directed = False, generator = None):
         """
         Samples the graph according to the given probabillty.
 
@@ -25,12 +23,14 @@ class DegreeEdgeSampler(GraphSampler):
                           connected by the edge.
             graph_save_dir (str): The path to store the sampled graph
             directed (bool): If the graph is directed or not.
+            generator (torch.Generator): The cpu generator used to sample the edges, the global one if None.
         """
         super(DegreeEdgeSampler).__init__()
         self.p = p
         self.method = method
         self.graph_save_dir = graph_save_dir
         self.directed = directed
+        self.generator = generator
     
     def sample_graph(self, original_graph):
         """
@@ -61,7 +61,7 @@ class DegreeEdgeSampler(GraphSampler):
 
         total_edges = src_ids.shape[0]
         num_edges_to_sample = int(total_edges * self.p)
-        edges_sampled = random.choices(np.arange(total_edges), weights = weights, k = num_edges_to_sample)
+        edges_sampled = weighted_choices(weights, num_edges_to_sample, generator = self.generator)
         edge_idx_to_remove = torch.ones(total_edges).bool()
         edge_idx_to_remove[edges_sampled] = False
         
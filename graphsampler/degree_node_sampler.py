@@ -4,16 +4,15 @@
 import torch
 import os
 import dgl
-from .graph_sampler import GraphSampler
+from .graph_sampler import GraphSampler, weighted_choices
 import copy
-import random
 
 class DegreeNodeSampler(GraphSampler):
     """
     Samples the nodes in the graph in a uniform way.
     """
 
-    def __init__(self, p = 0.5, method = 'higher', graph_save_dir = None):
+    def __init__(self, p = 0.5, method = 'higher', graph_save_dir = None, generator = None):
         """
         Samples the graph according to the given probabillty.
 
@@ -22,11 +21,13 @@ class DegreeNodeSampler(GraphSampler):
             method (str): Higher or lower. If higher, higher degree nodes are sampled
                           more frequently.
             graph_save_dir (str): The path to store the sampled graph
+            generator (torch.Generator): The cpu generator used to sample the nodes, the global one if None.
         """
         super(DegreeNodeSampler).__init__()
         self.p = p
         self.method = method
         self.graph_save_dir = graph_save_dir
+        self.generator = generator
     
     def sample_graph(self, original_graph):
         """
@@ -47,7 +48,8 @@ class DegreeNodeSampler(GraphSampler):
             weights = 1. / ((original_graph.in_degrees() + original_graph.out_degrees()) ** 0.75)
 
         num_nodes_to_sample = int(original_graph.number_of_nodes() * self.p)
-        nodes_sampled = random.choices(original_graph.nodes().numpy(), weights = weights, k = num_nodes_to_sample)
+        # The node ids are 0 to N - 1, so the drawn indices are the sampled nodes.
+        nodes_sampled = weighted_choices(weights, num_nodes_to_sample, generator = self.generator)
         node_idx_to_remove = torch.ones(original_graph.number_of_nodes())
         node_idx_to_remove[nodes_sampled] = 0
         nodes_to_remove = original_graph.nodes()[node_idx_to_remove.bool()]
@@ -6,8 +6,96 @@ import os
 import dgl
 from .graph_sampler import GraphSampler
 import copy
-import random
-from tqdm import tqdm
+import numpy as np
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    # numba is optional, without it the burning procedure runs as plain python.
+    NUMBA_AVAILABLE = False
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+@njit(cache = True)
+def _forest_fire(indptr, indices, training_nodes, num_nodes_to_sample, p_f, seed):
+    """
+    Burns the training nodes of a graph in CSR format until num_nodes_to_sample nodes are burnt.
+    See ForestFireSampler for the description of the procedure.
+
+    Args:
+        indptr (np.ndarray): The CSR row pointers of the outgoing edges.
+        indices (np.ndarray): The CSR column indices of the outgoing edges.
+        training_nodes (np.ndarray): Boolean mask of the training nodes, only these are burnt.
+        num_nodes_to_sample (float): The number of nodes to burn.
+        p_f (float): The probability of a node of getting burnt.
+        seed (int): Seed for the random number generator.
+
+    Returns:
+        sampled_nodes (np.ndarray): Boolean mask of the burnt nodes.
+    """
+    # Compiled, this seeds numba's own generator. As plain python it seeds numpy's global
+    # one, forest_fire restores that afterwards.
+    np.random.seed(seed)
+    num_nodes = training_nodes.shape[0]
+    sampled_nodes = np.zeros(num_nodes, dtype = np.bool_)
+    # Nodes are marked with the number of the fire that visited/added them, so the marks
+    # do not have to be reset for every new fire.
+    visited = np.zeros(num_nodes, dtype = np.int64)
+    added = np.zeros(num_nodes, dtype = np.int64)
+    # Every node is added to the queue at most once per fire.
+    queue = np.empty(num_nodes, dtype = np.int64)
+    nodes_to_add = np.empty(num_nodes, dtype = np.int64)
+    num_sampled = 0
+    fire = 0
+    while num_sampled < num_nodes_to_sample:
+        fire += 1
+        num_to_add = 0
+        u = np.random.randint(0, num_nodes)
+        queue[0] = u
+        head, tail = 0, 1
+        first = True
+        added[u] = fire
+        while head < tail:
+            u = queue[head]
+            head += 1
+            if visited[u] == fire or not training_nodes[u] or sampled_nodes[u]:
+                continue
+            visited[u] = fire
+            if np.random.random() < p_f or first:
+                nodes_to_add[num_to_add] = u
+                num_to_add += 1
+                if num_to_add > num_nodes_to_sample:
+                    break
+                for i in range(indptr[u], indptr[u + 1]):
+                    v = indices[i]
+                    # The successor can be a non trianing node and we dont sample from there
+                    if visited[v] == fire or added[v] == fire or not training_nodes[v]:
+                        continue
+                    added[v] = fire
+                    queue[tail] = v
+                    tail += 1
+                first = False
+        for i in range(num_to_add):
+            sampled_nodes[nodes_to_add[i]] = True
+            num_sampled += 1
+            if num_sampled >= num_nodes_to_sample:
+                break
+    return sampled_nodes
+
+def forest_fire(indptr, indices, training_nodes, num_nodes_to_sample, p_f, seed):
+    """
+    Runs _forest_fire, see there for the arguments. Without numba the state of numpy's
+    global random number generator is restored afterwards, so seeding the fires does not
+    change the random numbers drawn elsewhere.
+    """
+    if NUMBA_AVAILABLE:
+        return _forest_fire(indptr, indices, training_nodes, num_nodes_to_sample, p_f, seed)
+    state = np.random.get_state()
+    try:
+        return _forest_fire(indptr, indices, training_nodes, num_nodes_to_sample, p_f, seed)
+    finally:
+        np.random.set_state(state)
 
 class ForestFireSampler(GraphSampler):
     """
@@ -15,7 +103,7 @@ class ForestFireSampler(GraphSampler):
     https://cs.stanford.edu/people/jure/pubs/sampling-kdd06.pdf
     """
 
-    def __init__(self, p = 0.5, p_f = 0.5, graph_save_dir = None):
+    def __init__(self, p = 0.5, p_f = 0.5, graph_save_dir = None, generator = None):
         """
         Samples the graph according to a forest fire procedure. First a seed
         node is sampled. After this node is burnt, every node connected to this
@@ -27,11 +115,13 @@ class ForestFireSampler(GraphSampler):
             p (float): Proportion of the nodes that should be present in the sampled graph
             p_f (float): The probability of a node of getting burnt.
             graph_save_dir (str): The path to store the sampled graph
+            generator (torch.Generator): The cpu generator used to seed the fires, the global one if None.
         """
         super(ForestFireSampler).__init__()
         self.p = p
         self.p_f = p_f
         self.graph_save_dir = graph_save_dir
+        self.generator = generator
 
     def sample_graph(self, original_graph):
         """
@@ -55,46 +145,19 @@ class ForestFireSampler(GraphSampler):
         if 'train' in original_graph.ndata:
             training_nodes = original_graph.ndata['train'].view(-1)
 
-        sampled_nodes = {}
         # Number of training nodes because there is a 1 for every training node.
         N = training_nodes.sum()
         print(self.p * N, N)
-        pbar = tqdm(ascii = True)
-        while len(sampled_nodes) < self.p * N:
-            nodes_to_add = []
-            visited = {}
-            added = {}
-            u = random.randint(0, original_graph.number_of_nodes() - 1)
-            queue = [u]
-            first = True
-            added[u] = True
-            while len(queue) > 0:
-                pbar.set_postfix_str(f'Length of queue {len(queue)} Prop {len(sampled_nodes) / N}')
-                u = queue.pop(0)
-                if u in visited or training_nodes[u] == 0 or u in sampled_nodes:
-                    continue
-                visited[u] = True
-                if random.random() < self.p_f or first:
-                    nodes_to_add.append(u)
-                    if len(nodes_to_add) > self.p * N:
-                        break
-                    for v in original_graph.successors(u).tolist():
-                        # The successor can be a non trianing node and we dont sample from there
-                        if v in visited or v in added or training_nodes[v] == 0:
-                            continue
-                        added[v] = True
-                        queue.append(v)
-                    first = False
-            for node in nodes_to_add:
-                sampled_nodes[node] = 1
-                if len(sampled_nodes) >= self.p * N:
-                    break
-        mask = torch.zeros(original_graph.number_of_nodes())
-        mask[training_nodes.bool()] = 1
-        assert mask[list(sampled_nodes.keys())].sum() == len(sampled_nodes)
-        mask[list(sampled_nodes.keys())] = 0
+        indptr, indices, _ = original_graph.adj_sparse('csr')
+        # The fires use their own generator, seed it from torch so the sampling stays reproducible.
+        seed = int(torch.randint(2 ** 31 - 1, (1,), generator = self.generator))
+        sampled_nodes = torch.from_numpy(forest_fire(indptr.numpy(), indices.numpy(),
+            training_nodes.bool().numpy(), float(self.p * N), self.p_f, seed))
+        # Only training nodes may be burnt.
+        assert training_nodes[sampled_nodes].bool().all()
+        mask = training_nodes.bool() & ~sampled_nodes
         sampled_graph = copy.deepcopy(original_graph)
-        sampled_graph.remove_nodes(sampled_graph.nodes()[mask.bool()])
+        sampled_graph.remove_nodes(sampled_graph.nodes()[mask])
 
         if self.graph_save_dir:
             torch.save(sampled_graph, filename)
@@ -2,6 +2,39 @@
 # SPDX-License-Identifier: Apache-2.0
 
 from abc import ABC, abstractmethod
+import math
+
+import torch
+
+def weighted_choices(weights, k, generator = None):
+    """
+    Draws k indices with replacement, each with a probability proportional to its weight.
+    Same as random.choices over the indices but done with a single tensor op for all the draws.
+    Runs on the cpu like the samplers that use it.
+
+    Args:
+        weights (torch.Tensor): The weight of every index.
+        k (int): The number of indices to draw.
+        generator (torch.Generator): The generator to draw from, the global one if None.
+
+    Returns:
+        choices (torch.Tensor): The drawn indices.
+
+    Raises:
+        ValueError: If the total of the weights is not finite, e.g. an inverse degree weight of
+            an isolated node, or not positive. Same as random.choices.
+    """
+    cum_weights = torch.cumsum(weights.double(), dim = 0)
+    total = float(cum_weights[-1])
+    if not math.isfinite(total):
+        raise ValueError('Total of weights must be finite')
+    if total <= 0:
+        raise ValueError('Total of weights must be greater than zero')
+    draws = torch.rand(k, dtype = torch.float64, generator = generator) * total
+    # Same bisection as random.choices. A draw rounded up to the total would land past the last
+    # index with a positive weight, so it is clamped to that index.
+    last = int(weights.nonzero()[-1])
+    return torch.searchsorted(cum_weights, draws, right = True).clamp_(max = last)
 
 class GraphSampler(ABC):
     """
@@ -6,15 +6,13 @@ import os
 import dgl
 from .graph_sampler import GraphSampler
 import copy
-import random
-import numpy as np
 
 class LabelEdgeSampler(GraphSampler):
     """
     Samples the edges in a graph using the labels of the nodes.
     """
 
-    def __init__(self, p = 0.5, homophilic_prob = 0.5, method = 'score', graph_save_dir = None, directed = False):
+    def __init__(self, p = 0.5, homophilic_prob = 0.5, method = 'score', graph_save_dir = None, directed = False, generator = None):
         """
         Samples the edges in the graph using given probabilities.
 
@@ -26,6 +24,7 @@ class LabelEdgeSampler(GraphSampler):
                           connected by the edge.
             graph_save_dir (str): The path to store the sampled graph
             directed (bool): If the graph is directed or not.
+            generator (torch.Generator): The cpu generator used to sample the edges, the global one if None.
         """
         super(LabelEdgeSampler).__init__()
         self.p = p
@@ -33,6 +32,7 @@ class LabelEdgeSampler(GraphSampler):
         self.method = method
         self.graph_save_dir = graph_save_dir
         self.directed = directed
+        self.generator = generator
     
     def sample_graph(self, original_graph):
         """
@@ -60,13 +60,13 @@ class LabelEdgeSampler(GraphSampler):
         total_edges = src_ids.shape[0]
         # Edges having the same src and dst label
         homophilic_edges = labels[src_ids].view(-1) == labels[dst_ids].view(-1)
-        homophilic_edges = homophilic_edges.nonzero().view(-1).numpy()
+        homophilic_edges = homophilic_edges.nonzero().view(-1)
         # Edges having different src and dst label
         heterophilic_edges = labels[src_ids].view(-1) != labels[dst_ids].view(-1)
-        heterophilic_edges = heterophilic_edges.nonzero().view(-1).numpy()
+        heterophilic_edges = heterophilic_edges.nonzero().view(-1)
         # Shuffle the indices of homophilic and heterophilic edges
-        homophilic_mask = torch.rand(homophilic_edges.shape[0]) < self.p * self.homophilic_prob
-        heterophilic_mask = torch.rand(heterophilic_edges.shape[0]) < self.p * (1 - self.homophilic_prob)
+        homophilic_mask = torch.rand(homophilic_edges.shape[0], generator = self.generator) < self.p * self.homophilic_prob
+        heterophilic_mask = torch.rand(heterophilic_edges.shape[0], generator = self.generator) < self.p * (1 - self.homophilic_prob)
         # Sample the homophilic and heterophilic edges in the final graph
         sampled_homophilic_edges = homophilic_edges[homophilic_mask]
         sampled_heterophilic_edges = heterophilic_edges[heterophilic_mask]
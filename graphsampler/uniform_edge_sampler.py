@@ -12,18 +12,20 @@ class UniformEdgeSampler(GraphSampler):
     This does not sample the graph at all and returns the full graph.
     """
 
-    def __init__(self, p = 0.5, graph_save_dir = None, directed = False):
+    def __init__(self, p = 0.5, graph_save_dir = None, directed = False, generator = None):
         """
         Samples the graph according to the given probabillty.
 
         Args:
             p (float): Probability of retaining an edge
             graph_save_dir (str): The path to store the sampled graph
+            generator (torch.Generator): The cpu generator used to sample the edges, the global one if None.
         """
         super(UniformEdgeSampler).__init__()
         self.p = p
         self.graph_save_dir = graph_save_dir
         self.directed = directed
+        self.generator = generator
     
     def sample_graph(self, original_graph):
         """
@@ -43,7 +45,7 @@ class UniformEdgeSampler(GraphSampler):
             dst_ids = dst_ids_original[src_ids_original < dst_ids_original]
 
             # Find all edges which need to be masked out
-            mask = torch.rand(len(src_ids)) > self.p
+            mask = torch.rand(len(src_ids), generator = self.generator) > self.p
             src_ids = src_ids[mask]
             dst_ids = dst_ids[mask]
 
@@ -57,7 +59,7 @@ class UniformEdgeSampler(GraphSampler):
             dst_ids = dst_ids_original[src_ids_original != dst_ids_original]
 
             # Find all edges which need to be masked out
-            mask = torch.rand(len(src_ids)) > self.p
+            mask = torch.rand(len(src_ids), generator = self.generator) > self.p
             src_ids = src_ids[mask]
             dst_ids = dst_ids[mask]
 
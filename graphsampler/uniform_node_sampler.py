@@ -14,19 +14,22 @@ class UniformNodeSampler(GraphSampler):
     Samples the nodes in the graph in a uniform way.
     """
 
-    def __init__(self, p = 0.5, retain_features = False, graph_save_dir = None, preprocess_features = False, model_path = None):
+    def __init__(self, p = 0.5, retain_features = False, graph_save_dir = None, preprocess_features = False, model_path = None,
+                 generator = None):
         """
         Samples the graph according to the given probabillty.
 
         Args:
             p (float): Probability of retaining a node (i.e sampling the node)
             graph_save_dir (str): The path to store the sampled graph
+            generator (torch.Generator): The cpu generator used to sample the nodes, the global one if None.
         """
         super(UniformNodeSampler).__init__()
         self.p = p
         self.retain_features = retain_features
         self.preprocess_features = preprocess_features
         self.graph_save_dir = graph_save_dir
+        self.generator = generator
     
     def sample_graph(self, original_graph):
         """
@@ -40,7 +43,7 @@ class UniformNodeSampler(GraphSampler):
             sampled_graph: the complete graph after 'sampling'
         """
         training_nodes = original_graph.nodes()
-        mask = torch.rand(training_nodes.shape[0]) > self.p
+        mask = torch.rand(training_nodes.shape[0], generator = self.generator) > self.p
         nodes_to_remove = training_nodes[mask]
         if self.preprocess_features:
             original_graph.update_all(fn.copy_u('feat', 'm'), fn.sum('m', 'feat'))
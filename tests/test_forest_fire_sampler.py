@@ -0,0 +1,43 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+import sys
+import math
+import numpy as np
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(THIS_DIR, "../"))
+
+from graphsampler.forest_fire_sampler import forest_fire
+
+def build_graph():
+    # A ring over 8 nodes with a few chords, nodes 6 and 7 are not training nodes.
+    edges = [(u, (u + 1) % 8) for u in range(8)] + [(0, 4), (1, 6), (2, 7), (6, 3), (7, 5)]
+    num_nodes = 8
+    indptr = np.zeros(num_nodes + 1, dtype = np.int64)
+    for u, _ in edges:
+        indptr[u + 1] += 1
+    indptr = np.cumsum(indptr)
+    indices = np.array([v for _, v in sorted(edges)], dtype = np.int64)
+    training_nodes = np.array([True] * 6 + [False] * 2)
+    return indptr, indices, training_nodes
+
+def test_forest_fire():
+    indptr, indices, training_nodes = build_graph()
+    N = training_nodes.sum()
+    for p in [0.1, 0.4, 0.5, 1.0]:
+        for seed in range(20):
+            sampled_nodes = forest_fire(indptr, indices, training_nodes, float(p * N), 0.5, seed)
+            assert sampled_nodes.sum() == math.ceil(p * N)
+            assert not sampled_nodes[~training_nodes].any()
+
+def test_forest_fire_is_seeded():
+    indptr, indices, training_nodes = build_graph()
+    first = forest_fire(indptr, indices, training_nodes, 3.0, 0.5, 7)
+    second = forest_fire(indptr, indices, training_nodes, 3.0, 0.5, 7)
+    assert (first == second).all()
+
+if __name__ == "__main__":
+    test_forest_fire()
+    test_forest_fire_is_seeded()
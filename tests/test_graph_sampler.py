@@ -0,0 +1,44 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import os
+import sys
+import math
+import torch
+
+THIS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(THIS_DIR, "../"))
+
+from graphsampler.graph_sampler import weighted_choices
+
+def test_weighted_choices():
+    weights = torch.tensor([0., 1., 0., 3., 0., 4., 0.])
+    k = 200000
+    choices = weighted_choices(weights, k, generator = torch.Generator().manual_seed(0))
+    assert choices.shape == (k,)
+    assert ((choices >= 0) & (choices < weights.shape[0])).all()
+    # Zero weight indices are never drawn.
+    assert (weights[choices] > 0).all()
+    # The draws follow the weights.
+    frequencies = torch.bincount(choices, minlength = weights.shape[0]).double() / k
+    assert torch.allclose(frequencies, weights.double() / weights.sum(), atol = 0.01)
+
+def test_weighted_choices_is_seeded():
+    weights = torch.rand(100)
+    first = weighted_choices(weights, 50, generator = torch.Generator().manual_seed(7))
+    second = weighted_choices(weights, 50, generator = torch.Generator().manual_seed(7))
+    assert (first == second).all()
+
+def test_weighted_choices_invalid_weights():
+    # The inverse degree of an isolated node is inf.
+    for weights in [torch.tensor([1., math.inf, 2.]), torch.zeros(3)]:
+        try:
+            weighted_choices(weights, 10)
+        except ValueError:
+            continue
+        assert False, f"No error for weights {weights}"
+
+if __name__ == "__main__":
+    test_weighted_choices()
+    test_weighted_choices_is_seeded()
+    test_weighted_choices_invalid_weights()
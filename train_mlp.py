@@ -2,12 +2,12 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import argparse
+import hashlib
 import random
 import os
 import numpy as np
 from tqdm import tqdm
 import time
-import copy
 import os
 
 import torch
@@ -26,6 +26,13 @@ from models import GCN, NodePredictorMLP
 from evaluators import NodeEvaluator
 from graphsampler import FullSampler, UniformEdgeSampler, UniformNodeSampler, DegreeNodeSampler, DegreeEdgeSampler, LabelEdgeSampler, ForestFireSampler, MaskGcnSampler
 
+# Dtypes used by autocast for each of the supported precisions, None runs in full precision.
+AMP_DTYPES = {
+    'fp32': None,
+    'bf16': torch.bfloat16,
+    'fp16': torch.float16,
+}
+
 def set_args_based_on_dataset(args):
     """
     Set the default arguments for some inputs based on the dataset.
@@ -33,6 +40,9 @@ def set_args_based_on_dataset(args):
 
     if args.dataset == 'ogbn-products':
         args.batch_size = 10000
+    elif args.dataset == 'ogbn-arxiv':
+        # The MLP is bound by the per step overheads, larger batches amortize them.
+        args.batch_size = 4096
 
 def parse_arguments():
     # Training settings
@@ -44,102 +54,485 @@ def parse_arguments():
     parser.add_argument('--log_dir', type = str, help = "Log directory to store the tensorboard")
     parser.add_argument('--checkpoint_dir', type = str, help = "Directory to store the model")
     parser.add_argument('--batch_size', type = int, default = 1024)
+    parser.add_argument('--eval_batch_size', type = int, default = 65536, help = 'Number of nodes per batch during evaluation')
     parser.add_argument('--neighbours', type = int, default = 10)
-    parser.add_argument('--num_workers', type = int, default = 2)
+    parser.add_argument('--num_workers', type = int, default = 0,
+                        help = 'Sampling worker processes of --loader neighbour, the default samples in the main process with prefetching. '
+                               'The index loader batches in the main process and ignores this')
     parser.add_argument('--num_epochs', type = int, default = 100)
     parser.add_argument('--hidden_dim', type = int, default = 256)
     parser.add_argument('--lr', type = float, default = 0.001)
     parser.add_argument('--log_every', type = int, default = 1)
+    parser.add_argument('--save_every', type = int, default = 10,
+                        help = 'Save the checkpoint every these many epochs (1 saves every epoch), it is also saved when validation improves')
     parser.add_argument('--gnn_layers', type = int, default = 3)
     parser.add_argument('--predictor_layers', type = int, default = 3)
-    parser.add_argument('--sampler', type = str, default = 'full', help = "can be full, uniform_edge, uniform_node, degree_node, degree_edge")
+    parser.add_argument('--sampler', type = str, default = 'full', help = "can be full, uniform_edge, uniform_node, degree_node, degree_edge, label_edge, forest_fire, mask_gcn")
     parser.add_argument('--method', type = str, default = 'higher', help = "can be higher or lower")
     parser.add_argument('--prob', type = float, default = 0.5)
     parser.add_argument('--homophilic_prob', type = float, default = 0.5)
     parser.add_argument('--p_f', type = float, default = 0.5)
     parser.add_argument('--dropout', type = float, default = 0.0)
     parser.add_argument('--mask_path', type = str)
-    return parser.parse_args()
+    parser.add_argument('--preload_features', action = 'store_true',
+                        help = 'Move the node features to the gpu once before training instead of copying them every batch')
+    parser.add_argument('--gpu_sampling', action = 'store_true',
+                        help = 'Sample the neighbours on the gpu from the pinned graph using UVA with --loader neighbour')
+    parser.add_argument('--loader', type = str, default = 'index', choices = ['index', 'neighbour'],
+                        help = 'index batches the training node ids directly, neighbour builds the sampled blocks with dgl')
+    parser.add_argument('--compile', action = 'store_true', help = 'JIT compile the model and the predictor with torch.compile')
+    parser.add_argument('--precision', type = str, default = 'fp32', choices = list(AMP_DTYPES.keys()),
+                        help = 'Precision used for the forward pass on the gpu, bf16 and fp16 use mixed precision')
+    args = parser.parse_args()
+    assert args.save_every >= 1, "--save_every must be at least 1"
+    return args
 
 def set_seeds():
-    torch.set_num_threads(1)
+    # Allow TF32 for the float32 matmuls on Ampere and newer gpus.
+    torch.set_float32_matmul_precision('high')
     np.random.seed(42)
     torch.manual_seed(42)
     torch.cuda.manual_seed(42)
     random.seed(42)
+    # The graph samplers draw from their own generator so their draws do not depend on
+    # anything else that uses the global torch generator. The samplers run on the cpu, so
+    # this is a cpu generator.
+    return torch.Generator().manual_seed(42)
+
+# Builds the graph sampler for each value of --sampler from the arguments, the dataset and the
+# generator the sampler draws from.
+_SAMPLERS = {
+    'full': lambda args, dataset, generator: FullSampler(args.checkpoint_dir),
+    'uniform_edge': lambda args, dataset, generator: UniformEdgeSampler(p = args.prob, graph_save_dir = args.checkpoint_dir,
+        directed = dataset.directed, generator = generator),
+    'uniform_node': lambda args, dataset, generator: UniformNodeSampler(p = args.prob, graph_save_dir = args.checkpoint_dir,
+        generator = generator),
+    'degree_node': lambda args, dataset, generator: DegreeNodeSampler(p = args.prob, graph_save_dir = args.checkpoint_dir,
+        method = args.method, generator = generator),
+    'degree_edge': lambda args, dataset, generator: DegreeEdgeSampler(p = args.prob, graph_save_dir = args.checkpoint_dir,
+        method = args.method, directed = dataset.directed, generator = generator),
+    'label_edge': lambda args, dataset, generator: LabelEdgeSampler(p = args.prob, homophilic_prob = args.homophilic_prob,
+        graph_save_dir = args.checkpoint_dir, directed = dataset.directed, generator = generator),
+    'forest_fire': lambda args, dataset, generator: ForestFireSampler(p = args.prob, p_f = args.p_f,
+        graph_save_dir = args.checkpoint_dir, generator = generator),
+    'mask_gcn': lambda args, dataset, generator: MaskGcnSampler(mask_path = args.mask_path, p = args.prob,
+        graph_save_dir = args.checkpoint_dir),
+}
+
+def sampling_key(args):
+    """
+    Returns the key of the sampling arguments the graph in the checkpoint directory was sampled
+    with, or None if there is nothing to cache.
+    """
+    if not args.checkpoint_dir or args.sampler == 'full':
+        return None
+    # hash() of strings changes across processes so the key is built with hashlib instead.
+    return hashlib.md5(repr((args.dataset, args.sampler, args.prob, args.p_f, args.homophilic_prob,
+        args.method, args.mask_path)).encode()).hexdigest()
 
-def sample_graph(dataset, args):
+def sample_graph(dataset, args, generator = None):
+    """
+    Samples the graph of the dataset. The samplers save the sampled graph to sampled_graph.pt in
+    the checkpoint directory, the key of the sampling arguments is stored next to it so that a
+    later run with the same arguments loads the graph instead of sampling it again.
+    """
     sampler_type = args.sampler
-    if sampler_type == 'full':
-        sampler = FullSampler(args.checkpoint_dir)
-    elif sampler_type == 'uniform_edge':
-        sampler = UniformEdgeSampler(p = args.prob, graph_save_dir = args.checkpoint_dir, directed = dataset.directed)
-    elif sampler_type == 'uniform_node':
-        sampler = UniformNodeSampler(p = args.prob, graph_save_dir = args.checkpoint_dir)
-    elif sampler_type == 'degree_node':
-        sampler = DegreeNodeSampler(p = args.prob, graph_save_dir = args.checkpoint_dir, method = args.method)
-    elif sampler_type == 'degree_edge':
-        sampler = DegreeEdgeSampler(p = args.prob, graph_save_dir = args.checkpoint_dir, method = args.method, directed = dataset.directed)
-    elif sampler_type == 'label_edge':
-        sampler = LabelEdgeSampler(p = args.prob, homophilic_prob = args.homophilic_prob,
-            graph_save_dir = args.checkpoint_dir, directed = dataset.directed)
-    elif sampler_type == 'forest_fire':
-        sampler = ForestFireSampler(p = args.prob, p_f = args.p_f, graph_save_dir = args.checkpoint_dir)
-    elif sampler_type == 'mask_gcn':
-        sampler = MaskGcnSampler(mask_path = args.mask_path, p = args.prob, graph_save_dir = args.checkpoint_dir)
+    assert sampler_type in _SAMPLERS, f"Unknown sampler {sampler_type}"
+    key = sampling_key(args)
+    if key:
+        graph_path = os.path.join(args.checkpoint_dir, 'sampled_graph.pt')
+        key_path = os.path.join(args.checkpoint_dir, 'sampled_graph.key')
+        if os.path.exists(graph_path) and os.path.exists(key_path):
+            with open(key_path) as f:
+                if f.read() == key:
+                    dataset.set_sampled_graph(torch.load(graph_path))
+                    print(f"Loaded the sampled graph from {graph_path}")
+                    return
+        # The graph was sampled with other arguments, remove it so that the samplers reading
+        # sampled_graph.pt back do not return it.
+        for path in [graph_path, key_path]:
+            if os.path.exists(path):
+                os.remove(path)
+    sampler = _SAMPLERS[sampler_type](args, dataset, generator)
     sampled_graph = sampler.sample_graph(dataset.graph)
+    if key:
+        with open(key_path, 'w') as f:
+            f.write(key)
     dataset.set_sampled_graph(sampled_graph)
     print("Sampled the graph")
 
-def train(model, predictor, dataloader, optimizer, device):
-    model.train()
-    predictor.train()
+def cast_features(dataset, dtype):
+    """
+    Casts the node features of the sampled and the original graph to the given dtype. The
+    full sampler shares the feature tensor between both the graphs, which is kept shared.
+
+    Args:
+        dataset (HomogenousNodeClsDataset): Dataset after the graph has been sampled.
+        dtype (torch.dtype): The dtype to store the features in.
+    """
+    feat = dataset.graph.ndata['feat']
+    original_feat = dataset.original_graph.ndata['feat']
+    shared = feat.data_ptr() == original_feat.data_ptr()
+    dataset.graph.ndata['feat'] = feat.to(dtype)
+    dataset.original_graph.ndata['feat'] = dataset.graph.ndata['feat'] if shared else original_feat.to(dtype)
+
+def preload_features(dataset, device):
+    """
+    Moves the node features of the sampled and the original graph to the device once so that
+    train and eval can index into them instead of copying features every batch. Falls back to
+    the per batch copies if the features do not fit in the free gpu memory.
+
+    Args:
+        dataset (HomogenousNodeClsDataset): Dataset after the graph has been sampled.
+        device (torch.device): Device on which the model is trained.
+
+    Returns:
+        train_feat (torch.Tensor): Features of the sampled graph on the device, or None.
+        eval_feat (torch.Tensor): Features of the original graph on the device, or None.
+    """
+    if device.type != 'cuda':
+        return None, None
+
+    train_feat = dataset.graph.ndata['feat']
+    eval_feat = dataset.original_graph.ndata['feat']
+    # The full sampler shares the feature tensor between both the graphs, only copy it once.
+    shared = train_feat.data_ptr() == eval_feat.data_ptr()
+    required_bytes = train_feat.element_size() * train_feat.nelement()
+    if not shared:
+        required_bytes += eval_feat.element_size() * eval_feat.nelement()
+    free_bytes, _ = torch.cuda.mem_get_info(device)
+    # Leave half of the free memory for the model, activations and the sampled blocks.
+    if required_bytes > 0.5 * free_bytes:
+        print(f"Not preloading features, need {required_bytes} bytes but only {free_bytes} bytes are free")
+        return None, None
+
+    train_feat = train_feat.to(device)
+    eval_feat = train_feat if shared else eval_feat.to(device)
+    return train_feat, eval_feat
+
+def to_device(tensor, device):
+    """
+    Copies a small tensor, like a batch of node ids, to the device without blocking the host.
+    Cpu tensors which are not pinned are pinned first since a copy from pageable memory is
+    always synchronous. Features are copied through PinnedGather instead.
+    """
+    if device.type == 'cuda' and tensor.device.type == 'cpu' and not tensor.is_pinned():
+        tensor = tensor.pin_memory()
+    return tensor.to(device, non_blocking = True)
+
+class PinnedGather(object):
+    """
+    Gathers rows of a cpu tensor straight into pinned buffers and copies them to the gpu without
+    blocking the host. The buffers are used in turn and a buffer is only written again once the
+    copy out of it has finished, so the next gather runs while the previous copy is in flight.
+    """
 
-    loss_accum = 0
+    def __init__(self, tensor, max_rows, device, num_buffers = 2):
+        """
+        Args:
+            tensor (torch.Tensor): The cpu tensor to gather the rows from.
+            max_rows (int): The maximum number of rows gathered at once.
+            device (torch.device): The gpu to copy the rows to.
+            num_buffers (int): The number of pinned buffers used in turn.
+        """
+        self.tensor = tensor
+        self.device = device
+        self.buffers = [torch.empty((max_rows,) + tuple(tensor.shape[1:]), dtype = tensor.dtype).pin_memory()
+                        for _ in range(num_buffers)]
+        self.events = [None for _ in range(num_buffers)]
+        self.next_buffer = 0
+
+    def _copy(self, fill, num_rows):
+        i = self.next_buffer
+        self.next_buffer = (i + 1) % len(self.buffers)
+        # Wait for the copy out of this buffer from num_buffers calls ago.
+        if self.events[i] is not None:
+            self.events[i].synchronize()
+        buffer = self.buffers[i][:num_rows]
+        fill(buffer)
+        rows = buffer.to(self.device, non_blocking = True)
+        self.events[i] = torch.cuda.Event()
+        self.events[i].record(torch.cuda.current_stream(self.device))
+        return rows
+
+    def gather(self, idx):
+        """
+        Returns the rows idx of the tensor on the device.
+        """
+        idx = idx.cpu()
+        return self._copy(lambda buffer: torch.index_select(self.tensor, 0, idx, out = buffer), idx.shape[0])
+
+    def narrow(self, start, length):
+        """
+        Returns the rows start to start + length of the tensor on the device.
+        """
+        return self._copy(lambda buffer: buffer.copy_(self.tensor[start:start + length]), length)
+
+def compile_module(module, device):
+    """
+    JIT compiles the module with torch.compile. On cuda the reduce-overhead mode captures the
+    module in cuda graphs, which removes the launch overhead of the small matmuls in the MLP.
+
+    Args:
+        module (nn.Module): The module to compile.
+        device (torch.device): Device on which the module runs.
+
+    Returns:
+        compiled_module (nn.Module): The compiled module sharing parameters with module.
+    """
+    if not hasattr(torch, 'compile'):
+        print("torch.compile needs torch >= 2.0, running the module eagerly")
+        return module
+    mode = 'reduce-overhead' if device.type == 'cuda' else 'default'
+    return torch.compile(module, mode = mode, fullgraph = True)
+
+def batch_sizes(num_items, batch_size):
+    """
+    Returns the distinct sizes of the batches when num_items are split into batches of batch_size.
+    """
+    sizes = [min(batch_size, num_items)]
+    if num_items > batch_size and num_items % batch_size != 0:
+        sizes.append(num_items % batch_size)
+    return sizes
+
+def warmup(full_net, train_batch_sizes, eval_batch_sizes, feat_dim, device, amp_dtype = None, num_runs = 3):
+    """
+    Runs the module over dummy batches of every shape it sees in train and in eval, in training
+    mode and under inference_mode respectively, so that neither the compilation nor the capture
+    of the cuda graphs is counted in the time of the first epoch. Every shape is run a few times
+    since reduce-overhead only captures the cuda graph after the first runs. The gradients of
+    the dummy batches are dropped.
+
+    Args:
+        full_net (nn.Module): The compiled module.
+        train_batch_sizes (list): The sizes of the training batches.
+        eval_batch_sizes (list): The sizes of the evaluation batches.
+        feat_dim (int): The feature dimension of the nodes.
+        device (torch.device): Device on which the module runs.
+        amp_dtype (torch.dtype): The autocast dtype, None for full precision.
+        num_runs (int): The number of times every shape is run.
+    """
+    dtype = amp_dtype or torch.float32
+    full_net.train()
+    for batch_size in train_batch_sizes:
+        for _ in range(num_runs):
+            feat = torch.randn(batch_size, feat_dim, device = device, dtype = dtype)
+            with torch.autocast(device_type = device.type, dtype = amp_dtype, enabled = amp_dtype is not None):
+                output = full_net(feat)
+            output.float().sum().backward()
+    for param in full_net.parameters():
+        param.grad = None
+
+    full_net.eval()
+    with torch.inference_mode():
+        for batch_size in eval_batch_sizes:
+            for _ in range(num_runs):
+                feat = torch.randn(batch_size, feat_dim, device = device, dtype = dtype)
+                with torch.autocast(device_type = device.type, dtype = amp_dtype, enabled = amp_dtype is not None):
+                    full_net(feat)
+
+def gather(source, idx, device):
+    """
+    Gathers the rows idx of a tensor or a PinnedGather and returns them on the device. Tensors
+    are indexed where they live, which is the device unless training on the cpu.
+    """
+    if isinstance(source, PinnedGather):
+        return source.gather(idx)
+    return source[to_device(idx, source.device)]
+
+def load_batch(batch, device, node_feat = None, node_labels = None):
+    """
+    Returns the features and the labels of the output nodes of a batch on the device.
+
+    Args:
+        batch: A tensor of node ids from the index loader or the (input_nodes, output_nodes, mfgs)
+               tuple from the dgl dataloader.
+        device (torch.device): Device on which the model is trained.
+        node_feat (torch.Tensor or PinnedGather): Features of all the nodes in the graph. Read from the
+                                                  blocks if None.
+        node_labels (torch.Tensor): Labels of all the nodes in the graph on the device. Read from the
+                                    blocks if None.
+
+    Returns:
+        feat (torch.Tensor): Features of the output nodes.
+        labels (torch.Tensor): Labels of the output nodes.
+    """
+    if isinstance(batch, torch.Tensor):
+        output_nodes, mfgs = batch, None
+    else:
+        input_nodes, output_nodes, mfgs = batch
+    if node_feat is not None:
+        feat = gather(node_feat, output_nodes, device)
+    else:
+        feat = to_device(mfgs[-1].dstdata['feat'], device)
+    if node_labels is not None:
+        labels = gather(node_labels, output_nodes, device)
+    else:
+        labels = to_device(mfgs[-1].dstdata['label'], device)
+    # Gathered rows can be strided, which would make every linear layer copy its input.
+    return feat.contiguous(), labels
+
+def threads_per_process(num_workers):
+    """
+    Returns the share of the cores for each of the processes when the main process samples
+    with num_workers worker processes.
+    """
+    return max(1, os.cpu_count() // (num_workers + 1))
+
+def set_worker_threads(worker_id):
+    """
+    Sets the torch threads of a sampling worker to its share of the cores. torch limits every
+    dataloader worker to a single thread before this is called.
+    """
+    torch.set_num_threads(threads_per_process(torch.utils.data.get_worker_info().num_workers))
+
+def build_index_loader(train_idx, batch_size, device):
+    """
+    Builds a loader which yields shuffled batches of the training node ids. The MLP ignores the
+    graph structure, so this skips the neighbour sampling and the block construction entirely.
+    """
+    # Batches of ids are sampled at once so indexing train_idx returns the whole batch.
+    batch_sampler = torch.utils.data.BatchSampler(
+        torch.utils.data.RandomSampler(train_idx), batch_size = batch_size, drop_last = False)
+    return torch.utils.data.DataLoader(train_idx, sampler = batch_sampler, batch_size = None,
+        pin_memory = device.type == 'cuda')
+
+def build_neighbour_loader(dataset, args, device, gpu_sampling, prefetch_labels, model):
+    """
+    Builds the dgl dataloader which samples the neighbours of the training nodes into blocks.
+    """
+    # Neighbour sampler for sampling the neighbours while constructing the graph
+    if isinstance(model, NodePredictorMLP):
+        # The MLP only reads the output nodes of the last block, a single block without any
+        # sampled neighbours is enough to carry them and their prefetched data.
+        neighbour_sampler = dgl.dataloading.NeighborSampler([0], prefetch_labels = prefetch_labels)
+    elif args.neighbours == -1:
+        neighbour_sampler = dgl.dataloading.MultiLayerFullNeighborSampler(args.gnn_layers, prefetch_labels = prefetch_labels)
+    else:
+        neighbour_sampler = dgl.dataloading.NeighborSampler([args.neighbours for _ in range(args.gnn_layers)],
+            prefetch_labels = prefetch_labels)
+
+    if gpu_sampling:
+        # The graph is pinned and sampled on the gpu through UVA, which does not
+        # work with worker processes.
+        return dgl.dataloading.DataLoader(
+            dataset.graph, dataset.train_idx.to(device), neighbour_sampler,
+            batch_size=args.batch_size, shuffle=True, drop_last=False, num_workers=0,
+            device = device, use_uva = True)
+    # The batches are built on the cpu with pinned node ids, train gathers the features and the
+    # labels of the output nodes and copies them to the gpu asynchronously.
+    return dgl.dataloading.DataLoader(
+        dataset.graph, dataset.train_idx, neighbour_sampler,
+        batch_size=args.batch_size, shuffle=True, drop_last=False, num_workers=args.num_workers,
+        device = torch.device('cpu'), pin_memory = device.type == 'cuda', persistent_workers = args.num_workers > 0,
+        worker_init_fn = set_worker_threads)
+
+def prefetch_batch(iterator, device, copy_stream, node_feat = None, node_labels = None):
+    """
+    Loads the next batch of the iterator onto the device. The copies are issued on copy_stream
+    if given, so that they overlap with the compute on the current stream.
+
+    Returns:
+        batch (tuple): The features and the labels of the batch, None once the iterator is exhausted.
+    """
+    batch = next(iterator, None)
+    if batch is None:
+        return None
+    if copy_stream is None:
+        return load_batch(batch, device, node_feat = node_feat, node_labels = node_labels)
+    # The gathers can read tensors which were written on the current stream.
+    copy_stream.wait_stream(torch.cuda.current_stream(device))
+    with torch.cuda.stream(copy_stream):
+        return load_batch(batch, device, node_feat = node_feat, node_labels = node_labels)
+
+def train(full_net, dataloader, optimizer, device, node_feat = None, node_labels = None, log_every_steps = 50,
+          amp_dtype = None, scaler = None):
+    full_net.train()
+
+    # The loss is accumulated on the device, calling item() every step would synchronize
+    # the host with the gpu.
+    loss_accum = torch.zeros((), device = device)
     loss_fn = torch.nn.CrossEntropyLoss()
     macs_sum = 0
-    with tqdm(dataloader) as tq:
-        for step, (input_nodes, output_nodes, mfgs) in enumerate(tq):
-            optimizer.zero_grad()
+    # On cuda the next batch is copied to the gpu on a side stream while the current batch
+    # is being trained on.
+    copy_stream = torch.cuda.Stream(device = device) if device.type == 'cuda' else None
+    iterator = iter(dataloader)
+    next_batch = prefetch_batch(iterator, device, copy_stream, node_feat = node_feat, node_labels = node_labels)
+    step = 0
+    with tqdm(total = len(dataloader)) as tq:
+        while next_batch is not None:
+            if copy_stream is not None:
+                current_stream = torch.cuda.current_stream(device)
+                current_stream.wait_stream(copy_stream)
+                # The batch was allocated on the copy stream, keep its memory alive until the
+                # current stream is done with it.
+                for tensor in next_batch:
+                    tensor.record_stream(current_stream)
+            feat, output_labels = next_batch
+            next_batch = prefetch_batch(iterator, device, copy_stream, node_feat = node_feat, node_labels = node_labels)
+
+            optimizer.zero_grad(set_to_none = True)
             
             # TODO(rajabans): Add regularization to the model.
             # import pdb; pdb.set_trace()
             # feat = mfgs[0].srcdata['feat'].to(device)
-            feat = mfgs[-1].dstdata['feat'].to(device)
             # macs, _ = profile(model, inputs=(mfgs, feat))
             # macs_sum += macs / 1000000
             # x = model(mfgs, feat)
-            x = model(feat)
-            output_predictions = predictor(x)
-            output_labels = mfgs[-1].dstdata['label']
-
-            loss = loss_fn(output_predictions, output_labels.view(-1))
-
-            loss.backward()
-
-            optimizer.step()
-
-            tq.set_postfix_str(f'loss = {loss.detach().cpu().item()}')
-            loss_accum += loss.detach().cpu().item()
+            with torch.autocast(device_type = device.type, dtype = amp_dtype, enabled = amp_dtype is not None):
+                output_predictions = full_net(feat)
+
+            # The loss is always computed in full precision.
+            loss = loss_fn(output_predictions.float(), output_labels)
+
+            if scaler is not None:
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                loss.backward()
+                optimizer.step()
+
+            loss_accum += loss.detach()
+            if step % log_every_steps == 0:
+                tq.set_postfix_str(f'loss = {loss.detach().item()}')
+            tq.update(1)
+            step += 1
     
-    # return loss_accum / (step + 1), macs_sum
-    return loss_accum / (step + 1)
+    # return loss_accum.item() / step, macs_sum
+    return loss_accum.item() / step
 
-@torch.no_grad()
-def eval(model, predictor, dataset, evaluator, batch_size, neighbours, device, split = 'valid'):
-    model.eval()
-    predictor.eval()
+@torch.inference_mode()
+def eval(full_net, dataset, evaluator, batch_size, neighbours, device, split = 'valid', node_feat = None, amp_dtype = None):
+    full_net.eval()
 
-    feat = dataset.original_graph.ndata['feat'].to(device)
+    # Either the preloaded features, a PinnedGather over the cpu features or the cpu features.
+    if node_feat is not None:
+        feat = node_feat
+    else:
+        feat = dataset.original_graph.ndata['feat']
+    num_nodes = dataset.original_graph.number_of_nodes()
     # Doing the inference over graphs already present in the dataset.
     # infer_embs = model.inference(dataset.original_graph, feat, batch_size, neighbours, device).to(device)
-    infer_embs = model(feat)
+    # The predictor is part of full_net so these are already the class scores. The nodes are
+    # processed in batches so that only a batch of features has to be on the device at a time.
+    infer_embs = []
+    for start in range(0, num_nodes, batch_size):
+        if isinstance(feat, PinnedGather):
+            batch_feat = feat.narrow(start, min(batch_size, num_nodes - start))
+        else:
+            batch_feat = feat[start:start + batch_size].to(device)
+        with torch.autocast(device_type = device.type, dtype = amp_dtype, enabled = amp_dtype is not None):
+            # The outputs of a model compiled with cuda graphs are overwritten by the next call.
+            infer_embs.append(full_net(batch_feat).clone())
+    infer_embs = torch.cat(infer_embs)
     
     val_score = evaluator.eval(infer_embs)
     return val_score
 
 def main():
-    set_seeds()
+    generator = set_seeds()
 
     args = parse_arguments()
     set_args_based_on_dataset(args)
@@ -149,6 +542,16 @@ def main():
     print(device)
     print(args)
 
+    # The index loader does no neighbour sampling, so there is nothing to move to the gpu.
+    assert not args.gpu_sampling or args.loader == 'neighbour', "--gpu_sampling needs --loader neighbour"
+    gpu_sampling = args.gpu_sampling and device.type == 'cuda'
+    # Only the cpu neighbour loader starts sampling workers, split the cores between them and
+    # the main process instead of pinning torch to a single thread, which starved the cpu side
+    # ops and dgl's OpenMP sampler. The workers take their share in set_worker_threads.
+    # Otherwise the main process gets all the cores.
+    num_workers = args.num_workers if args.loader == 'neighbour' and not gpu_sampling else 0
+    torch.set_num_threads(threads_per_process(num_workers))
+
     if args.log_dir != '':
         writer = SummaryWriter(log_dir=args.log_dir)
     else:
@@ -158,23 +561,69 @@ def main():
 
     # Graph sampling - This is where we do the preprocessing step. Here we sample
     # nodes and edges to reduce the size of the graph.
-    sample_graph(dataset, args)
+    sample_graph(dataset, args, generator = generator)
 
-    # Neighbour sampler for sampling the neighbours while constructing the graph
-    if args.neighbours == -1:
-        neighbour_sampler = dgl.dataloading.MultiLayerFullNeighborSampler(args.gnn_layers)
-    else:
-        neighbour_sampler = dgl.dataloading.NeighborSampler([args.neighbours for _ in range(args.gnn_layers)])
+    # CrossEntropyLoss needs 1-D int64 targets, convert the labels once instead of every batch.
+    dataset.graph.ndata['label'] = dataset.graph.ndata['label'].view(-1).long().contiguous()
 
-    train_loader = dgl.dataloading.DataLoader(
-        dataset.graph, dataset.train_idx, neighbour_sampler,
-        batch_size=args.batch_size, shuffle=True, drop_last=False, num_workers=args.num_workers, device = device)
+    # Double precision features only cost bandwidth, the model runs in float32.
+    if dataset.graph.ndata['feat'].dtype == torch.float64:
+        cast_features(dataset, torch.float32)
+
+    # Mixed precision is only used on the gpu. The features are stored in the lower
+    # precision as well which halves the host to device traffic.
+    amp_dtype = AMP_DTYPES[args.precision] if device.type == 'cuda' else None
+    if amp_dtype is not None:
+        cast_features(dataset, amp_dtype)
+    # Gradients are scaled for fp16 to avoid underflow, bf16 has the range of fp32.
+    scaler = torch.cuda.amp.GradScaler() if amp_dtype == torch.float16 else None
+
+    train_feat, eval_feat = None, None
+    if args.preload_features:
+        train_feat, eval_feat = preload_features(dataset, device)
 
     model = NodePredictorMLP(dataset.feat_dim, args.hidden_dim, args.hidden_dim, 3).to(device)
     predictor = NodePredictorMLP(args.hidden_dim, args.hidden_dim, dataset.num_classes, 1).to(device)
-    evaluator = NodeEvaluator(dataset = dataset, predictor = predictor)
     optimizer = optim.Adam(list(model.parameters()) + list(predictor.parameters()), lr = args.lr)
 
+    # Features which are not preloaded are gathered into pinned buffers on the host so that
+    # they can be copied to the gpu asynchronously.
+    if eval_feat is None and device.type == 'cuda':
+        eval_feat = PinnedGather(dataset.original_graph.ndata['feat'], args.eval_batch_size, device)
+
+    if args.loader == 'neighbour' and gpu_sampling:
+        # The MLP only reads the features and labels of the output nodes, these are prefetched
+        # through UVA into the dstdata of the last block while sampling. Preloaded features
+        # are indexed directly.
+        prefetch_labels = ['label'] if train_feat is not None else ['feat', 'label']
+        train_loader = build_neighbour_loader(dataset, args, device, gpu_sampling, prefetch_labels, model)
+        node_feat, node_labels = train_feat, None
+    else:
+        # The features and labels are gathered with the output node ids of a batch.
+        if args.loader == 'index':
+            train_loader = build_index_loader(dataset.train_idx, args.batch_size, device)
+        else:
+            train_loader = build_neighbour_loader(dataset, args, device, gpu_sampling, None, model)
+        if train_feat is not None:
+            node_feat = train_feat
+        elif device.type == 'cuda':
+            node_feat = PinnedGather(dataset.graph.ndata['feat'], args.batch_size, device)
+        else:
+            node_feat = dataset.graph.ndata['feat']
+        node_labels = dataset.graph.ndata['label'].to(device)
+
+    # The MLP does not use the blocks, so the model and the predictor are run as a single
+    # module which lets torch.compile fuse across the boundary between the two.
+    # full_net shares its parameters with model, which is kept so that the saved state
+    # dict has the usual keys.
+    full_net = nn.Sequential(model, predictor)
+    if args.compile:
+        full_net = compile_module(full_net, device)
+        warmup(full_net, batch_sizes(dataset.train_idx.shape[0], args.batch_size),
+            batch_sizes(dataset.original_graph.number_of_nodes(), args.eval_batch_size),
+            dataset.feat_dim, device, amp_dtype = amp_dtype)
+    evaluator = NodeEvaluator(dataset = dataset, predictor = None)
+
     best_val_perf = -float('inf')
     result_dict = {
         "args": args.__dict__,
@@ -187,33 +636,43 @@ def main():
         start_clock = time.time()
         print("=====Epoch {}".format(epoch))
 
-        # loss, macs_sum = train(model, predictor, train_loader, optimizer, device)
-        loss = train(model, predictor, train_loader, optimizer, device)
+        # loss, macs_sum = train(full_net, train_loader, optimizer, device)
+        loss = train(full_net, train_loader, optimizer, device, node_feat = node_feat,
+            node_labels = node_labels, amp_dtype = amp_dtype, scaler = scaler)
         print(f'The loss is {loss}')
         if writer is not None:
-            writer.add_scalar('train/loss', loss, epoch)
+            writer.add_scalar('train/loss', loss, epoch, new_style = True)
 
+        improved = False
         if epoch % args.log_every == 0:
-            val_perf = eval(model, predictor, dataset, evaluator, args.batch_size, args.neighbours, device)
+            val_perf = eval(full_net, dataset, evaluator, args.eval_batch_size, args.neighbours, device, node_feat = eval_feat, amp_dtype = amp_dtype)
             print(f'The validation score is {val_perf}')
 
             if writer is not None:
-                writer.add_scalar('valid/score', val_perf, epoch)
+                writer.add_scalar('valid/score', val_perf, epoch, new_style = True)
 
             if val_perf > best_val_perf:
                 best_val_perf = val_perf
                 result_dict['val_perf'] = val_perf
-                result_dict['gnn'] = copy.deepcopy(model.state_dict())
+                # One copy per tensor to the cpu, which is cheaper than deepcopy and does not
+                # keep a second set of weights on the gpu.
+                result_dict['gnn'] = {k: v.detach().to('cpu', copy = True) for k, v in model.state_dict().items()}
                 result_dict['epoch'] = epoch
+                improved = True
 
         time_for_epoch = time.process_time() - start
         time_for_epoch_clock = time.time() - start_clock
         result_dict['epoch_times'].append(time_for_epoch)
         result_dict['epoch_times_clock'].append(time_for_epoch_clock)
         # result_dict['macs_sum'].append(macs_sum)
-        # TODO(rajabans): Check if this file exists and fail if it does. Give an arg to overwrite if present.
-        if args.checkpoint_dir:
-            torch.save(result_dict, os.path.join(args.checkpoint_dir, "checkpoint.pt"))
+        # The checkpoint and the logs are only written out when the model improves or every
+        # save_every epochs, the epoch times are kept in memory and saved at the end.
+        if improved or epoch % args.save_every == args.save_every - 1:
+            if writer is not None:
+                writer.flush()
+            # TODO(rajabans): Check if this file exists and fail if it does. Give an arg to overwrite if present.
+            if args.checkpoint_dir:
+                torch.save(result_dict, os.path.join(args.checkpoint_dir, "checkpoint.pt"))
     
     if writer is not None:
         writer.close()